@@ -0,0 +1,380 @@
+"""
+eager-load authors and recipients in /api/messages/with/<user_id>
+"""
+VERSION = "21"
+
+import json
+from datetime import datetime as DateTime
+import requests
+import click
+
+from flask import Flask
+from flask import request
+from flask import render_template
+from flask import redirect
+from flask_socketio import SocketIO
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.sql import text
+from sqlalchemy.orm import selectinload
+
+## usual Flask initilization
+app = Flask(__name__)
+socketio = SocketIO(app)
+
+## DB declaration
+
+# filename where to store stuff (sqlite is file-based)
+db_name = 'chat.db'
+# how do we connect to the database ?
+# here we say it's by looking in a file named chat.db
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_name
+# this variable, db, will be used for all SQLAlchemy commands
+db = SQLAlchemy(app)
+
+
+## define a table in the database
+
+class User(db.Model):
+    __tablename__ = 'users'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String)
+    email = db.Column(db.String)
+    nickname = db.Column(db.String)
+
+class Message(db.Model):
+    __tablename__ = 'messages'
+    id = db.Column(db.Integer, primary_key=True)
+    content = db.Column(db.String)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    recipient_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    date = db.Column(db.DateTime)
+
+    # Define relationships (to fetch User objects directly)
+    author = db.relationship('User', foreign_keys=[author_id], backref='sent_messages')
+    recipient = db.relationship('User', foreign_keys=[recipient_id], backref='received_messages')
+
+    # without these, finding the messages of one user means scanning the whole table
+    # with them, the DB can jump right to the rows of a given author (or recipient)
+    # and they come out already sorted by date
+    __table_args__ = (
+        db.Index('ix_messages_author_date', 'author_id', 'date'),
+        db.Index('ix_messages_recipient_date', 'recipient_id', 'date'),
+    )
+
+# actually create the database (i.e. tables etc)
+with app.app_context():
+    db.create_all()
+    # create_all() skips tables that already exist, and so their indexes as well;
+    # this takes care of databases created with an earlier step
+    for index in Message.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+@app.route('/')
+def hello_world():
+    # redirect to /front/users
+    # actually this is just a rsponse with a 301 HTTP code
+    return redirect('/front/users')
+
+
+# try it with
+"""
+http :5001/db/alive
+"""
+@app.route('/db/alive')
+def db_alive():
+    try:
+        result = db.session.execute(text('SELECT 1'))
+        print(result)
+        return dict(status="healthy", message="Database connection is alive")
+    except Exception as e:
+        # e holds description of the error
+        error_text = "<p>The error:<br>" + str(e) + "</p>"
+        hed = '<h1>Something is broken.</h1>'
+        return hed + error_text
+
+
+# try it with
+"""
+http :5001/api/version
+"""
+@app.route('/api/version')
+def version():
+    return dict(version=VERSION)
+
+
+# try it with
+"""
+http :5001/api/users name="Alice Caroll" email="alice@foo.com" nickname="alice"
+http :5001/api/users name="Bob Morane" email="bob@foo.com" nickname="bob"
+http :5001/api/users name="Charlie Chaplin" email="charlie@foo.com" nickname="charlie"
+"""
+@app.route('/api/users', methods=['POST'])
+def create_user():
+    # we expect the user to send a JSON object
+    # with the 3 fields name email and nickname
+    try:
+        parameters = json.loads(request.data)
+        name = parameters['name']
+        email = parameters['email']
+        nickname = parameters['nickname']
+        print("received request to create user", name, email, nickname)
+        # temporary
+        new_user = User(name=name, email=email, nickname=nickname)
+        db.session.add(new_user)
+        db.session.commit()
+        return parameters
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+
+
+# try it with
+"""
+http :5001/api/users
+"""
+@app.route('/api/users', methods=['GET'])
+def list_users():
+    users = User.query.all()
+    return [dict(
+            id=user.id, name=user.name, email=user.email, nickname=user.nickname)
+        for user in users]
+
+
+# try it with
+"""
+http :5001/api/users/1
+"""
+@app.route('/api/users/<int:id>', methods=['GET'])
+def list_user(id):
+    try:
+        # as id is the primary key
+        user = User.query.get(id)
+        return dict(
+            id=user.id, name=user.name, email=user.email, nickname=user.nickname)
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+
+
+# try it with
+"""
+http :5001/api/messages author_id=1 recipient_id=2 content="trois petits chats"
+http :5001/api/messages author_id=2 recipient_id=1 content="chapeau de paille"
+http :5001/api/messages author_id=1 recipient_id=2 content="paillasson"
+http :5001/api/messages author_id=2 recipient_id=1 content="somnambule"
+http :5001/api/messages author_id=1 recipient_id=2 content="bulletin"
+http :5001/api/messages author_id=2 recipient_id=1 content="tintamarre"
+http :5001/api/messages author_id=2 recipient_id=3 content="not visible by 1"
+"""
+@app.route('/api/messages', methods=['POST'])
+def create_message():
+    try:
+        parameters = json.loads(request.data)
+        content = parameters['content']
+        author_id = parameters['author_id']
+        recipient_id = parameters['recipient_id']
+        # check that author and recipient exist
+        author = User.query.get(author_id)
+        recipient = User.query.get(recipient_id)
+        date = DateTime.now()
+        print("received request to create message", author_id, recipient_id, content)
+        new_message = Message(content=content, date=date,
+                              author_id=author_id, recipient_id=recipient_id)
+        db.session.add(new_message)
+        db.session.commit()
+        # expose more details in the response
+        parameters['author'] = dict(
+            id=author.id, name=author.name, email=author.email, nickname=author.nickname)
+        parameters['recipient'] = dict(
+            id=recipient.id, name=recipient.name, email=recipient.email, nickname=recipient.nickname)
+        parameters['date'] = date
+        # we might have considered writing this
+        # socket.emit(recipient.nickname, json.dumps(parameters))
+        # however it won't work as-is because of the datetime filed which is not serializable
+        # it turns out flask knows how to serialize it, but for socketio we need to do it ourselves
+        # quick nd dirty way is this
+        socketio.emit(recipient.nickname, json.dumps(parameters, default=str))
+        return parameters
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+
+
+# try it with
+"""
+http :5001/api/messages
+"""
+@app.route('/api/messages', methods=['GET'])
+def list_messages():
+    messages = Message.query.all()
+    return [dict(
+            id=message.id, content=message.content, date=message.date,
+            author_id=message.author_id, recipient_id=message.recipient_id)
+        for message in messages]
+
+
+# try it with
+"""
+http :5001/api/messages/with/1
+"""
+@app.route('/api/messages/with/<int:recipient_id>', methods=['GET'])
+def list_messages_to(recipient_id):
+    """
+    returns only messages to and from a given person
+    need to write a little more elaborate query
+    we still can only return author_id and recipient_id
+    """
+    # we could write this as a single filter with or_(author, recipient)
+    # but then the DB cannot use any of our indexes and scans the whole table
+    # with a UNION, each half is a range scan in its own index
+    sent = Message.query.filter(Message.author_id==recipient_id)
+    received = Message.query.filter(Message.recipient_id==recipient_id)
+    messages = (
+        sent.union(received)
+        .order_by(Message.date, Message.id)
+        # without this, each access to message.author or message.recipient
+        # below would trigger its own SELECT on the users table - up to 2N of them
+        # with selectinload, all the users involved are fetched in one more query
+        .options(selectinload(Message.author), selectinload(Message.recipient))
+        .all()
+    )
+    # now we have in message.author and message.recipient
+    # the actual User objects - and as the session keeps one object per row,
+    # all the messages from the same person share the same User instance
+    return [
+        dict(
+            id=message.id,
+            author = dict(
+                id=message.author.id, name=message.author.name,
+                email=message.author.email, nickname=message.author.nickname),
+            recipient = dict(
+                id=message.recipient.id, name=message.recipient.name,
+                email=message.recipient.email, nickname=message.recipient.nickname),
+            content=message.content,  date=message.date)
+        for message in messages
+    ]
+
+
+# the number of queries behind a conversation page must not depend on its length
+# this command makes sure of it, so that the N+1 problem cannot sneak back in:
+# it builds conversations of growing sizes - in a transaction that is rolled back
+# in the end, so the database is left untouched - and counts the queries of
+# list_messages_to(); it fails - with a non-zero exit code - if the count varies
+# each message comes from a different user: with the same 2 users all along,
+# the session would load each of them once, and hide the problem
+# (past 500 different users, selectinload needs one more query per batch of 500 ids;
+# that's fine, the count is still not one per message)
+# try it with
+"""
+flask check-queries
+flask check-queries --size 10 --size 200
+"""
+@app.cli.command('check-queries')
+@click.option('--size', type=int, multiple=True, default=[1, 10, 100, 500],
+              help='how many messages in the conversation - may be repeated')
+def check_queries(size):
+    # the statements sent to the database, whatever the code that sends them
+    queries = []
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+    counts = {}
+    with app.app_context():
+        bob = User(name="Bob", email="bob@check-queries", nickname="bob")
+        db.session.add(bob)
+        db.session.flush()
+        bob_id = bob.id
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+        try:
+            created = 0
+            for count in sorted(size):
+                for id in range(created, count):
+                    author = User(name=f"User {id}", email=f"user{id}@check-queries",
+                                  nickname=f"user{id}")
+                    db.session.add(Message(content=f"message number {id}", date=DateTime.now(),
+                                           author=author, recipient_id=bob_id))
+                db.session.flush()
+                created = count
+                # the first call warms up whatever may be cached along the way; and
+                # each call starts with an empty session, like a request would
+                for _ in range(2):
+                    db.session.expunge_all()
+                    queries.clear()
+                    with app.test_request_context():
+                        response = app.make_response(list_messages_to(bob_id))
+                if response.status_code != 200:
+                    raise click.ClickException(f"{count} messages: {response.get_json()}")
+                counts[count] = len(queries)
+                print(f"{count:>8,} messages: {counts[count]} queries")
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_query)
+            db.session.rollback()
+    if len(set(counts.values())) > 1:
+        raise click.ClickException("the number of queries depends on the number of messages")
+
+
+## Frontend
+# for clarity we define our routes in the /front namespace
+# however in practice /front/users would probably be just /users
+
+# try it by pointing your browser to
+"""
+http://localhost:5001/front/users
+"""
+@app.route('/front/users')
+def front_users():
+    # first option of course, is to get all users from DB
+    # users = User.query.all()
+    # but in a more fragmented architecture we would need to
+    # get that info at another endpoint
+    # here we ask ourselves on the /api/users route
+    url = request.url_root + '/api/users'
+    req = requests.get(url)
+    if not (200 <= req.status_code < 300):
+        # return render_template('errors.html', error='...')
+        return dict(error=f"could not request users list", url=url,
+                    status=req.status_code, text=req.text)
+    users = req.json()
+    return render_template('users.html.j2', users=users, version=VERSION)
+
+
+# try it by pointing your browser to
+"""
+http://localhost:5001/front/messages/1
+"""
+@app.route('/front/messages/<int:recipient>')
+def front_messages(recipient):
+    # same as for the users, let's pretend we don't have direct access to the DB
+    url = request.url_root + f'/api/users/{recipient}'
+    req1 = requests.get(url)
+    if not (200 <= req1.status_code < 300):
+        return dict(error="could not request user info", url=url,
+                    status=req1.status_code, text=req1.text)
+    user = req1.json()
+    req2 = requests.get(request.url_root + f'/api/messages/with/{recipient}')
+    if not (200 <= req2.status_code < 300):
+        return dict(error="could not request messages list", url=url,
+                    status=req2.status_code, text=req2.text)
+    messages = req2.json()
+    # not trying to optimize for now
+    url = request.url_root + '/api/users'
+    req3 = requests.get(url)
+    users = req3.json()
+    return render_template(
+        'messages.html.j2',
+        user=user, messages=messages,
+        users=users,
+    )
+
+#
+# cannot be triggered through http
+# there is a socket-io CLI client that can be installed with
+# npm i -g socket.io-cli
+# in our case, the first test will be from the messages HTML page
+#
+@socketio.on('connect-ack')
+def connect_ack(message):
+    print(f'received ACK message: {message} of type {type(message)}')
+
+
+if __name__ == '__main__':
+    socketio.run(app)
@@ -0,0 +1,59 @@
+// surprisingly there is no way to tell a <form> that it should submit as JSON
+
+const formToJSON = form => Object.fromEntries(new FormData(form))
+
+document.addEventListener('DOMContentLoaded', async (event) => {
+    console.log("connecting to the SocketIO backend")
+    const socket = io()
+    // we are storing the nickname in the body element
+    const message_row = (data) => {
+        // this is assume to be a an object (so JSON.parse before if necessary)
+        const {author, recipient, content, date} = data
+        const newRow = document.createElement('tr')
+        newRow.innerHTML = `<td>${date}</td><td>${author.nickname}</td><td>${recipient.nickname}</td><td>${content}</td>`
+        return newRow
+    }
+    const tbody = document.querySelector('#messages tbody')
+    const display_new_message = (data) => tbody.appendChild(message_row(data))
+    const nickname = document.body.dataset.nickname
+    const user_id = document.body.dataset.userId
+    socket.on('connect', () => {
+        console.log('Connected!')
+        socket.emit('connect-ack', {messages: `${nickname} has connected!`})
+    })
+    // so we can subscribe to that channel
+    socket.on(nickname, (str) => display_new_message(JSON.parse(str)))
+    console.log(`subscribed to the ${nickname} channel`)
+    // the page comes with the most recent messages only
+    // older ones are fetched one page at a time, when the user asks for them
+    const older = document.getElementById('older-messages')
+    older?.addEventListener('click', async () => {
+        const cursor = encodeURIComponent(older.dataset.cursor)
+        const response = await fetch(`/api/messages/with/${user_id}?before=${cursor}`)
+        const {messages, next_cursor} = await response.json()
+        // the page is in chronological order, so we insert from the end
+        for (const message of messages.reverse())
+            tbody.prepend(message_row(message))
+        if (next_cursor)
+            older.dataset.cursor = next_cursor
+        else
+            older.remove()
+    })
+    document.getElementById('send-form').addEventListener('submit',
+        async (event) => {
+            // turn off default form behaviour
+            event.preventDefault()
+            const json = formToJSON(event.target)
+            const action = event.target.action
+            await fetch(action, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(json)
+            })
+            .then((response) => response.json())
+            .then(display_new_message)
+            .catch((error) => {
+                console.error('Error:', error)
+            })
+        })
+    })
\ No newline at end of file
@@ -0,0 +1,575 @@
+"""
+one SocketIO room per user, and new messages go to the 2 rooms involved
+"""
+VERSION = "25"
+
+import os
+import json
+import time
+from datetime import datetime as DateTime
+import requests
+import click
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+from flask import request
+from flask import render_template
+from flask import redirect
+from flask_socketio import SocketIO
+from flask_socketio import join_room
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.sql import text
+from sqlalchemy.sql import select
+from sqlalchemy.sql import union
+from sqlalchemy.sql import tuple_
+from sqlalchemy.orm import selectinload
+
+## usual Flask initilization
+app = Flask(__name__)
+socketio = SocketIO(app)
+
+## DB declaration
+
+# filename where to store stuff (sqlite is file-based)
+db_name = 'chat.db'
+# how do we connect to the database ?
+# here we say it's by looking in a file named chat.db
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_name
+# this variable, db, will be used for all SQLAlchemy commands
+db = SQLAlchemy(app)
+
+
+## define a table in the database
+
+class User(db.Model):
+    __tablename__ = 'users'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String)
+    email = db.Column(db.String)
+    nickname = db.Column(db.String)
+
+class Message(db.Model):
+    __tablename__ = 'messages'
+    id = db.Column(db.Integer, primary_key=True)
+    content = db.Column(db.String)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    recipient_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    date = db.Column(db.DateTime)
+
+    # Define relationships (to fetch User objects directly)
+    author = db.relationship('User', foreign_keys=[author_id], backref='sent_messages')
+    recipient = db.relationship('User', foreign_keys=[recipient_id], backref='received_messages')
+
+    # without these, finding the messages of one user means scanning the whole table
+    # with them, the DB can jump right to the rows of a given author (or recipient)
+    # and they come out already sorted by date
+    __table_args__ = (
+        db.Index('ix_messages_author_date', 'author_id', 'date'),
+        db.Index('ix_messages_recipient_date', 'recipient_id', 'date'),
+        # this one is for paginating the whole list of messages
+        db.Index('ix_messages_date', 'date'),
+    )
+
+# actually create the database (i.e. tables etc)
+with app.app_context():
+    db.create_all()
+    # create_all() skips tables that already exist, and so their indexes as well;
+    # this takes care of databases created with an earlier step
+    for index in Message.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+## pagination
+# the messages endpoints return at most one page of messages
+# a page is located by a cursor, that is made of the (date, id) of a message
+# so fetching a page deep down in the history costs the same as the first one
+# (unlike with OFFSET, where the DB needs to skip all the previous rows)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(message):
+    return f"{message.date.isoformat()}_{message.id}"
+
+
+def decode_cursor(cursor):
+    date, id = cursor.rsplit('_', 1)
+    return DateTime.fromisoformat(date), int(id)
+
+
+def page_parameters():
+    """
+    returns before, after, limit from the query string of the current request
+    before and after are decoded cursors, or None
+    """
+    before = request.args.get('before')
+    after = request.args.get('after')
+    if before and after:
+        raise ValueError("before= and after= are mutually exclusive")
+    limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    if not (1 <= limit <= MAX_PAGE_SIZE):
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return (decode_cursor(before) if before else None,
+            decode_cursor(after) if after else None,
+            limit)
+
+
+def keyset(query, before, after, limit):
+    """
+    restricts a query on messages to one page
+    with after=, we go forward in time and the oldest messages come first
+    otherwise we go back in time, starting from before= (or from the newest message)
+    """
+    key = tuple_(Message.date, Message.id)
+    if after:
+        return query.filter(key > after).order_by(Message.date, Message.id).limit(limit)
+    if before:
+        query = query.filter(key < before)
+    return query.order_by(Message.date.desc(), Message.id.desc()).limit(limit)
+
+
+def make_page(messages, after, limit, to_dict):
+    """
+    messages come in the order returned by keyset()
+    the page always lists them in chronological order
+    next_cursor is where to resume in the same direction, or None if we're done
+    """
+    if not after:
+        messages = messages[::-1]
+    next_cursor = None
+    if len(messages) == limit:
+        next_cursor = encode_cursor(messages[-1] if after else messages[0])
+    return dict(messages=[to_dict(message) for message in messages],
+                next_cursor=next_cursor)
+
+
+## services
+# the actual logic behind the API, as plain Python functions
+# they are called by the /api endpoints of course, but also directly by
+# the /front pages - which saves them a round trip to their own server
+
+def user_to_dict(user):
+    return dict(id=user.id, name=user.name, email=user.email, nickname=user.nickname)
+
+
+def get_users():
+    return [user_to_dict(user) for user in User.query.all()]
+
+
+def get_user(id):
+    # as id is the primary key
+    user = db.session.get(User, id)
+    if user is None:
+        raise LookupError(f"no user with id {id}")
+    return user_to_dict(user)
+
+
+def get_messages(before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    messages = keyset(Message.query, before, after, limit).all()
+    return make_page(messages, after, limit, lambda message: dict(
+            id=message.id, content=message.content, date=message.date,
+            author_id=message.author_id, recipient_id=message.recipient_id))
+
+
+def get_messages_with(user_id, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    returns only messages to and from a given person
+    """
+    # we could write this as a single filter with or_(author, recipient)
+    # but then the DB cannot use any of our indexes and scans the whole table
+    # with a UNION, each half is a range scan in its own index
+    # each half is also cut to one page, so we pick the page among at most 2 * limit ids
+    # (the nested select is because SQLite won't accept a LIMIT inside a UNION)
+    def one_side(column):
+        side = keyset(select(Message.id).filter(column==user_id), before, after, limit)
+        return select(side.subquery().c.id)
+    page_ids = union(one_side(Message.author_id), one_side(Message.recipient_id))
+    messages = (
+        keyset(Message.query.filter(Message.id.in_(page_ids)), before, after, limit)
+        # without this, each access to message.author or message.recipient
+        # below would trigger its own SELECT on the users table - up to 2N of them
+        # with selectinload, all the users involved are fetched in one more query
+        .options(selectinload(Message.author), selectinload(Message.recipient))
+        .all()
+    )
+    # now we have in message.author and message.recipient
+    # the actual User objects - and as the session keeps one object per row,
+    # all the messages from the same person share the same User instance
+    return make_page(messages, after, limit, lambda message: dict(
+            id=message.id,
+            author=user_to_dict(message.author),
+            recipient=user_to_dict(message.recipient),
+            content=message.content,  date=message.date))
+
+
+@app.route('/')
+def hello_world():
+    # redirect to /front/users
+    # actually this is just a rsponse with a 301 HTTP code
+    return redirect('/front/users')
+
+
+# try it with
+"""
+http :5001/db/alive
+"""
+@app.route('/db/alive')
+def db_alive():
+    try:
+        result = db.session.execute(text('SELECT 1'))
+        print(result)
+        return dict(status="healthy", message="Database connection is alive")
+    except Exception as e:
+        # e holds description of the error
+        error_text = "<p>The error:<br>" + str(e) + "</p>"
+        hed = '<h1>Something is broken.</h1>'
+        return hed + error_text
+
+
+# try it with
+"""
+http :5001/api/version
+"""
+@app.route('/api/version')
+def version():
+    return dict(version=VERSION)
+
+
+# try it with
+"""
+http :5001/api/users name="Alice Caroll" email="alice@foo.com" nickname="alice"
+http :5001/api/users name="Bob Morane" email="bob@foo.com" nickname="bob"
+http :5001/api/users name="Charlie Chaplin" email="charlie@foo.com" nickname="charlie"
+"""
+@app.route('/api/users', methods=['POST'])
+def create_user():
+    # we expect the user to send a JSON object
+    # with the 3 fields name email and nickname
+    try:
+        parameters = json.loads(request.data)
+        name = parameters['name']
+        email = parameters['email']
+        nickname = parameters['nickname']
+        print("received request to create user", name, email, nickname)
+        # temporary
+        new_user = User(name=name, email=email, nickname=nickname)
+        db.session.add(new_user)
+        db.session.commit()
+        return parameters
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+
+
+# try it with
+"""
+http :5001/api/users
+"""
+@app.route('/api/users', methods=['GET'])
+def list_users():
+    return get_users()
+
+
+# try it with
+"""
+http :5001/api/users/1
+"""
+@app.route('/api/users/<int:id>', methods=['GET'])
+def list_user(id):
+    try:
+        return get_user(id)
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+
+
+# try it with
+"""
+http :5001/api/messages author_id=1 recipient_id=2 content="trois petits chats"
+http :5001/api/messages author_id=2 recipient_id=1 content="chapeau de paille"
+http :5001/api/messages author_id=1 recipient_id=2 content="paillasson"
+http :5001/api/messages author_id=2 recipient_id=1 content="somnambule"
+http :5001/api/messages author_id=1 recipient_id=2 content="bulletin"
+http :5001/api/messages author_id=2 recipient_id=1 content="tintamarre"
+http :5001/api/messages author_id=2 recipient_id=3 content="not visible by 1"
+"""
+@app.route('/api/messages', methods=['POST'])
+def create_message():
+    try:
+        parameters = json.loads(request.data)
+        content = parameters['content']
+        author_id = parameters['author_id']
+        recipient_id = parameters['recipient_id']
+        # check that author and recipient exist
+        author = get_user(author_id)
+        recipient = get_user(recipient_id)
+        date = DateTime.now()
+        print("received request to create message", author_id, recipient_id, content)
+        new_message = Message(content=content, date=date,
+                              author_id=author_id, recipient_id=recipient_id)
+        db.session.add(new_message)
+        db.session.commit()
+        # expose more details in the response
+        parameters['author'] = author
+        parameters['recipient'] = recipient
+        parameters['date'] = date
+        # we might have considered writing this
+        # socket.emit(recipient.nickname, json.dumps(parameters))
+        # however it won't work as-is because of the datetime filed which is not serializable
+        # it turns out flask knows how to serialize it, but for socketio we need to do it ourselves
+        # quick nd dirty way is this
+        # the message is sent only to the clients of the author and the recipient
+        # (and not to all the connected clients, which would then need to filter)
+        socketio.emit('new-message', json.dumps(parameters, default=str),
+                      to=[user_room(author_id), user_room(recipient_id)])
+        return parameters
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+
+
+# try it with
+"""
+http :5001/api/messages
+http :5001/api/messages limit==2
+http :5001/api/messages before==<the next_cursor from the previous answer>
+"""
+@app.route('/api/messages', methods=['GET'])
+def list_messages():
+    try:
+        before, after, limit = page_parameters()
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+    return get_messages(before, after, limit)
+
+
+# try it with
+"""
+http :5001/api/messages/with/1
+http :5001/api/messages/with/1 limit==2
+"""
+@app.route('/api/messages/with/<int:recipient_id>', methods=['GET'])
+def list_messages_to(recipient_id):
+    try:
+        before, after, limit = page_parameters()
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+    return get_messages_with(recipient_id, before, after, limit)
+
+
+# the number of queries behind a conversation page must not depend on its length
+# this command makes sure of it, so that the N+1 problem cannot sneak back in:
+# it builds conversations of growing sizes - in a transaction that is rolled back
+# in the end, so the database is left untouched - and counts the queries of
+# list_messages_to(); it fails - with a non-zero exit code - if the count varies
+# each message comes from a different user: with the same 2 users all along,
+# the session would load each of them once, and hide the problem
+# (past 500 different users, selectinload needs one more query per batch of 500 ids;
+# that's fine, the count is still not one per message)
+# try it with
+"""
+flask check-queries
+flask check-queries --size 10 --size 200
+"""
+@app.cli.command('check-queries')
+@click.option('--size', type=int, multiple=True, default=[1, 10, 100, 500],
+              help='how many messages in the conversation - may be repeated')
+def check_queries(size):
+    # the statements sent to the database, whatever the code that sends them
+    queries = []
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+    counts = {}
+    with app.app_context():
+        bob = User(name="Bob", email="bob@check-queries", nickname="bob")
+        db.session.add(bob)
+        db.session.flush()
+        bob_id = bob.id
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+        try:
+            created = 0
+            for count in sorted(size):
+                for id in range(created, count):
+                    author = User(name=f"User {id}", email=f"user{id}@check-queries",
+                                  nickname=f"user{id}")
+                    db.session.add(Message(content=f"message number {id}", date=DateTime.now(),
+                                           author=author, recipient_id=bob_id))
+                db.session.flush()
+                created = count
+                # the first call warms up whatever may be cached along the way; and
+                # each call starts with an empty session, like a request would
+                for _ in range(2):
+                    db.session.expunge_all()
+                    queries.clear()
+                    with app.test_request_context():
+                        response = app.make_response(list_messages_to(bob_id))
+                if response.status_code != 200:
+                    raise click.ClickException(f"{count} messages: {response.get_json()}")
+                counts[count] = len(queries)
+                print(f"{count:>8,} messages: {counts[count]} queries")
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_query)
+            db.session.rollback()
+    if len(set(counts.values())) > 1:
+        raise click.ClickException("the number of queries depends on the number of messages")
+
+
+## Frontend
+# for clarity we define our routes in the /front namespace
+# however in practice /front/users would probably be just /users
+
+# the pages need the same data as the API exposes
+# by default they simply call the services above, within the same process
+# but in a more fragmented architecture, the API would be deployed as a separate
+# service; set CHAT_API_URL (e.g. to http://api.example.com) and the pages
+# will fetch their data over HTTP, like we did in the previous steps
+app.config['API_URL'] = os.environ.get('CHAT_API_URL')
+# in seconds - a page should rather fail than hang forever on a stuck API
+app.config['API_TIMEOUT'] = float(os.environ.get('CHAT_API_TIMEOUT', 5))
+# how many API calls can be in flight at the same time, for all pages together
+API_POOL_SIZE = 16
+
+# a requests.Session keeps its connections open (keep-alive) and reuses them,
+# instead of opening a new connection for each call
+api_session = requests.Session()
+api_session.mount('http://', HTTPAdapter(pool_maxsize=API_POOL_SIZE))
+api_session.mount('https://', HTTPAdapter(pool_maxsize=API_POOL_SIZE))
+# the threads that send the API calls on behalf of the pages
+api_executor = ThreadPoolExecutor(max_workers=API_POOL_SIZE)
+
+
+def call_api(path, service, *args):
+    """
+    returns what service(*args) returns - either by calling it directly,
+    or by requesting path on the remote API
+    """
+    api_url = app.config['API_URL']
+    if not api_url:
+        return service(*args)
+    req = api_session.get(api_url + path, timeout=app.config['API_TIMEOUT'])
+    if not (200 <= req.status_code < 300):
+        raise RuntimeError(f"could not request {path}: {req.status_code} {req.text}")
+    return req.json()
+
+
+def call_apis(*calls):
+    """
+    each call is a tuple (path, service, *args) as expected by call_api()
+    returns the list of their results, in the same order
+
+    over HTTP, the calls are sent all at once, so that we wait for the slowest one
+    instead of the sum of all of them
+    in-process, they are simply made one after the other, as the services
+    need the database session of the current request
+    """
+    if not app.config['API_URL']:
+        return [call_api(*call) for call in calls]
+    futures = [api_executor.submit(call_api, *call) for call in calls]
+    return [future.result() for future in futures]
+
+
+# try it by pointing your browser to
+"""
+http://localhost:5001/front/users
+"""
+@app.route('/front/users')
+def front_users():
+    try:
+        users = call_api('/api/users', get_users)
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 500
+    return render_template('users.html.j2', users=users, version=VERSION)
+
+
+# try it by pointing your browser to
+"""
+http://localhost:5001/front/messages/1
+"""
+@app.route('/front/messages/<int:recipient>')
+def front_messages(recipient):
+    try:
+        # the 3 calls do not depend on each other
+        user, page, users = call_apis(
+            (f'/api/users/{recipient}', get_user, recipient),
+            # this gives us the most recent page only; the older ones are fetched
+            # by the JS code, if and when the user asks for them
+            (f'/api/messages/with/{recipient}', get_messages_with, recipient),
+            ('/api/users', get_users),
+        )
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 500
+    return render_template(
+        'messages.html.j2',
+        user=user, messages=page['messages'], next_cursor=page['next_cursor'],
+        users=users,
+    )
+
+## SocketIO
+
+def user_room(user_id):
+    return f"user-{user_id}"
+
+
+# each client tells us, when it connects, which user it is acting for
+# so we can put it in the room of that user
+# NOTE: there is no authentication in this app, so we have to trust the client on that
+@socketio.on('connect')
+def connect(auth):
+    user_id = (auth or {}).get('user_id')
+    if user_id is None:
+        # refuse the connection
+        return False
+    join_room(user_room(user_id))
+
+
+#
+# cannot be triggered through http
+# there is a socket-io CLI client that can be installed with
+# npm i -g socket.io-cli
+# in our case, the first test will be from the messages HTML page
+#
+@socketio.on('connect-ack')
+def connect_ack(message):
+    print(f'received ACK message: {message} of type {type(message)}')
+
+
+# what one message costs to deliver as the number of connected clients grows,
+# with the rooms, and with the broadcast that create_message did before
+# the clients are Flask-SocketIO test clients: the server handles them like real ones,
+# except that what it sends them lands in a list in memory rather than on a socket
+# each client acts for its own user, and the messages go from user 1 to user 2
+# try it with
+"""
+flask bench-fanout
+flask bench-fanout --clients 100 --clients 10000 --messages 20
+"""
+@app.cli.command('bench-fanout')
+@click.option('--clients', type=int, multiple=True, default=[100, 1000, 10_000],
+              help='how many connected clients - may be repeated')
+@click.option('--messages', default=100, help='how many messages for each measure')
+def bench_fanout(clients, messages):
+    payload = json.dumps(dict(content="hello", author_id=1, recipient_id=2,
+                              date=DateTime.now()), default=str)
+    emits = {
+        'rooms': lambda: socketio.emit('new-message', payload,
+                                       to=[user_room(1), user_room(2)]),
+        'broadcast': lambda: socketio.emit('user2', payload),
+    }
+    for count in clients:
+        connected = [socketio.test_client(app, auth=dict(user_id=id + 1))
+                     for id in range(count)]
+        for name, emit in emits.items():
+            start = time.perf_counter()
+            for _ in range(messages):
+                emit()
+            elapsed = (time.perf_counter() - start) / messages
+            received = sum(len(client.get_received()) for client in connected)
+            print(f"{count:>8,} clients - {name:>9}: {elapsed * 1e6:>10,.1f} µs per message, "
+                  f"{received / messages:>8,.0f} clients reached")
+        for client in connected:
+            client.disconnect()
+
+
+if __name__ == '__main__':
+    socketio.run(app)
@@ -0,0 +1,934 @@
+"""
+SocketIO goes through a message queue, so several workers can share the clients
+"""
+VERSION = "27"
+
+import os
+
+# how the server handles concurrency; one of
+# - threading: one OS thread per connection - the default, fine for development
+# - eventlet or gevent: green threads, that are much lighter; needs pip install eventlet (or gevent)
+# this needs to be decided before anything else gets imported, because both
+# eventlet and gevent work by patching the standard library (sockets, threads, ...)
+# so that all blocking calls - including the DB driver and requests - yield to other green threads
+ASYNC_MODE = os.environ.get('CHAT_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import sys
+import json
+import asyncio
+import base64
+import subprocess
+import tempfile
+import importlib.util
+import sqlite3
+import time
+from datetime import datetime as DateTime
+from argparse import ArgumentParser
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import click
+
+from flask import Flask
+from flask import request
+from flask import render_template
+from flask import redirect
+from flask_socketio import SocketIO
+from flask_socketio import join_room
+from socketio import PubSubManager
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.sql import text
+from sqlalchemy.sql import select
+from sqlalchemy.sql import union
+from sqlalchemy.sql import tuple_
+from sqlalchemy.orm import selectinload
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.schema import CreateIndex
+
+## a message queue for SocketIO
+# a client is connected to one process only; so when the app runs as several
+# processes (or on several machines), an emit done in one process must be relayed
+# to the others, and this is what a message queue is for
+# SocketIO knows about redis://, amqp://, kafka:// and zmq:// queues out of the box
+
+class SQLiteQueue(PubSubManager):
+    """
+    a stand-in message queue for SocketIO, using a table in a SQLite file
+    each process appends what it publishes, and polls for what the others published
+    good enough for tests, or for a few workers on a single machine
+    """
+    name = 'sqlite'
+    # how often we look for new messages, in seconds
+    poll_interval = 0.05
+    # how long published messages are kept, in seconds
+    retention = 60
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        # sqlite:////tmp/queue.db -> /tmp/queue.db
+        self.path = url[len('sqlite:///'):]
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS socketio_queue"
+                " (id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT, date REAL, data TEXT)")
+
+    def _connect(self):
+        # one connection per call, as we are called from several threads
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _publish(self, data):
+        with self._connect() as connection:
+            now = time.time()
+            connection.execute(
+                "INSERT INTO socketio_queue (channel, date, data) VALUES (?, ?, ?)",
+                (self.channel, now, self.json.dumps(data)))
+            connection.execute(
+                "DELETE FROM socketio_queue WHERE date < ?", (now - self.retention,))
+
+    def _listen(self):
+        connection = self._connect()
+        # we are only interested in what gets published from now on
+        last_id, = connection.execute("SELECT coalesce(max(id), 0) FROM socketio_queue").fetchone()
+        while True:
+            rows = connection.execute(
+                "SELECT id, data FROM socketio_queue WHERE channel = ? AND id > ? ORDER BY id",
+                (self.channel, last_id)).fetchall()
+            for last_id, data in rows:
+                yield data
+            self.server.sleep(self.poll_interval)
+
+
+# e.g. CHAT_MESSAGE_QUEUE=redis://localhost:6379/0
+# or   CHAT_MESSAGE_QUEUE=sqlite:////tmp/chat-queue.db
+def message_queue_options():
+    url = os.environ.get('CHAT_MESSAGE_QUEUE')
+    if not url:
+        return {}
+    if url.startswith('sqlite:///'):
+        return dict(client_manager=SQLiteQueue(url))
+    return dict(message_queue=url)
+
+
+## usual Flask initilization
+app = Flask(__name__)
+socketio = SocketIO(app, async_mode=ASYNC_MODE, **message_queue_options())
+
+## DB declaration
+
+# filename where to store stuff (sqlite is file-based)
+db_name = 'chat.db'
+# how do we connect to the database ?
+# here we say it's by looking in a file named chat.db
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_name
+# this variable, db, will be used for all SQLAlchemy commands
+db = SQLAlchemy(app)
+
+
+## define a table in the database
+
+class User(db.Model):
+    __tablename__ = 'users'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String)
+    email = db.Column(db.String)
+    nickname = db.Column(db.String)
+
+class Message(db.Model):
+    __tablename__ = 'messages'
+    id = db.Column(db.Integer, primary_key=True)
+    content = db.Column(db.String)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    recipient_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    date = db.Column(db.DateTime)
+
+    # Define relationships (to fetch User objects directly)
+    author = db.relationship('User', foreign_keys=[author_id], backref='sent_messages')
+    recipient = db.relationship('User', foreign_keys=[recipient_id], backref='received_messages')
+
+    # without these, finding the messages of one user means scanning the whole table
+    # with them, the DB can jump right to the rows of a given author (or recipient)
+    # and they come out already sorted by date
+    __table_args__ = (
+        db.Index('ix_messages_author_date', 'author_id', 'date'),
+        db.Index('ix_messages_recipient_date', 'recipient_id', 'date'),
+        # this one is for paginating the whole list of messages
+        db.Index('ix_messages_date', 'date'),
+    )
+
+# actually create the database (i.e. tables etc)
+# this used to be db.create_all(), that first checks what exists, and then creates the rest
+# but with several workers starting at the same time, 2 of them could try to create
+# the same table; with IF NOT EXISTS, the database takes care of that for us
+# (and we still create the indexes on databases created with an earlier step)
+with app.app_context():
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            connection.execute(CreateTable(table, if_not_exists=True))
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+## pagination
+# the messages endpoints return at most one page of messages
+# a page is located by a cursor, that is made of the (date, id) of a message
+# so fetching a page deep down in the history costs the same as the first one
+# (unlike with OFFSET, where the DB needs to skip all the previous rows)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(message):
+    return f"{message.date.isoformat()}_{message.id}"
+
+
+def decode_cursor(cursor):
+    date, id = cursor.rsplit('_', 1)
+    return DateTime.fromisoformat(date), int(id)
+
+
+def page_parameters():
+    """
+    returns before, after, limit from the query string of the current request
+    before and after are decoded cursors, or None
+    """
+    before = request.args.get('before')
+    after = request.args.get('after')
+    if before and after:
+        raise ValueError("before= and after= are mutually exclusive")
+    limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    if not (1 <= limit <= MAX_PAGE_SIZE):
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return (decode_cursor(before) if before else None,
+            decode_cursor(after) if after else None,
+            limit)
+
+
+def keyset(query, before, after, limit):
+    """
+    restricts a query on messages to one page
+    with after=, we go forward in time and the oldest messages come first
+    otherwise we go back in time, starting from before= (or from the newest message)
+    """
+    key = tuple_(Message.date, Message.id)
+    if after:
+        return query.filter(key > after).order_by(Message.date, Message.id).limit(limit)
+    if before:
+        query = query.filter(key < before)
+    return query.order_by(Message.date.desc(), Message.id.desc()).limit(limit)
+
+
+def make_page(messages, after, limit, to_dict):
+    """
+    messages come in the order returned by keyset()
+    the page always lists them in chronological order
+    next_cursor is where to resume in the same direction, or None if we're done
+    """
+    if not after:
+        messages = messages[::-1]
+    next_cursor = None
+    if len(messages) == limit:
+        next_cursor = encode_cursor(messages[-1] if after else messages[0])
+    return dict(messages=[to_dict(message) for message in messages],
+                next_cursor=next_cursor)
+
+
+## services
+# the actual logic behind the API, as plain Python functions
+# they are called by the /api endpoints of course, but also directly by
+# the /front pages - which saves them a round trip to their own server
+
+def user_to_dict(user):
+    return dict(id=user.id, name=user.name, email=user.email, nickname=user.nickname)
+
+
+def get_users():
+    return [user_to_dict(user) for user in User.query.all()]
+
+
+def get_user(id):
+    # as id is the primary key
+    user = db.session.get(User, id)
+    if user is None:
+        raise LookupError(f"no user with id {id}")
+    return user_to_dict(user)
+
+
+def get_messages(before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    messages = keyset(Message.query, before, after, limit).all()
+    return make_page(messages, after, limit, lambda message: dict(
+            id=message.id, content=message.content, date=message.date,
+            author_id=message.author_id, recipient_id=message.recipient_id))
+
+
+def get_messages_with(user_id, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    returns only messages to and from a given person
+    """
+    # we could write this as a single filter with or_(author, recipient)
+    # but then the DB cannot use any of our indexes and scans the whole table
+    # with a UNION, each half is a range scan in its own index
+    # each half is also cut to one page, so we pick the page among at most 2 * limit ids
+    # (the nested select is because SQLite won't accept a LIMIT inside a UNION)
+    def one_side(column):
+        side = keyset(select(Message.id).filter(column==user_id), before, after, limit)
+        return select(side.subquery().c.id)
+    page_ids = union(one_side(Message.author_id), one_side(Message.recipient_id))
+    messages = (
+        keyset(Message.query.filter(Message.id.in_(page_ids)), before, after, limit)
+        # without this, each access to message.author or message.recipient
+        # below would trigger its own SELECT on the users table - up to 2N of them
+        # with selectinload, all the users involved are fetched in one more query
+        .options(selectinload(Message.author), selectinload(Message.recipient))
+        .all()
+    )
+    # now we have in message.author and message.recipient
+    # the actual User objects - and as the session keeps one object per row,
+    # all the messages from the same person share the same User instance
+    return make_page(messages, after, limit, lambda message: dict(
+            id=message.id,
+            author=user_to_dict(message.author),
+            recipient=user_to_dict(message.recipient),
+            content=message.content,  date=message.date))
+
+
+@app.route('/')
+def hello_world():
+    # redirect to /front/users
+    # actually this is just a rsponse with a 301 HTTP code
+    return redirect('/front/users')
+
+
+# try it with
+"""
+http :5001/db/alive
+"""
+@app.route('/db/alive')
+def db_alive():
+    try:
+        result = db.session.execute(text('SELECT 1'))
+        print(result)
+        return dict(status="healthy", message="Database connection is alive")
+    except Exception as e:
+        # e holds description of the error
+        error_text = "<p>The error:<br>" + str(e) + "</p>"
+        hed = '<h1>Something is broken.</h1>'
+        return hed + error_text
+
+
+# try it with
+"""
+http :5001/api/version
+"""
+@app.route('/api/version')
+def version():
+    return dict(version=VERSION)
+
+
+# try it with
+"""
+http :5001/api/users name="Alice Caroll" email="alice@foo.com" nickname="alice"
+http :5001/api/users name="Bob Morane" email="bob@foo.com" nickname="bob"
+http :5001/api/users name="Charlie Chaplin" email="charlie@foo.com" nickname="charlie"
+"""
+@app.route('/api/users', methods=['POST'])
+def create_user():
+    # we expect the user to send a JSON object
+    # with the 3 fields name email and nickname
+    try:
+        parameters = json.loads(request.data)
+        name = parameters['name']
+        email = parameters['email']
+        nickname = parameters['nickname']
+        print("received request to create user", name, email, nickname)
+        # temporary
+        new_user = User(name=name, email=email, nickname=nickname)
+        db.session.add(new_user)
+        db.session.commit()
+        return parameters
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+
+
+# try it with
+"""
+http :5001/api/users
+"""
+@app.route('/api/users', methods=['GET'])
+def list_users():
+    return get_users()
+
+
+# try it with
+"""
+http :5001/api/users/1
+"""
+@app.route('/api/users/<int:id>', methods=['GET'])
+def list_user(id):
+    try:
+        return get_user(id)
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+
+
+# try it with
+"""
+http :5001/api/messages author_id=1 recipient_id=2 content="trois petits chats"
+http :5001/api/messages author_id=2 recipient_id=1 content="chapeau de paille"
+http :5001/api/messages author_id=1 recipient_id=2 content="paillasson"
+http :5001/api/messages author_id=2 recipient_id=1 content="somnambule"
+http :5001/api/messages author_id=1 recipient_id=2 content="bulletin"
+http :5001/api/messages author_id=2 recipient_id=1 content="tintamarre"
+http :5001/api/messages author_id=2 recipient_id=3 content="not visible by 1"
+"""
+@app.route('/api/messages', methods=['POST'])
+def create_message():
+    try:
+        parameters = json.loads(request.data)
+        content = parameters['content']
+        author_id = parameters['author_id']
+        recipient_id = parameters['recipient_id']
+        # check that author and recipient exist
+        author = get_user(author_id)
+        recipient = get_user(recipient_id)
+        date = DateTime.now()
+        print("received request to create message", author_id, recipient_id, content)
+        new_message = Message(content=content, date=date,
+                              author_id=author_id, recipient_id=recipient_id)
+        db.session.add(new_message)
+        db.session.commit()
+        # expose more details in the response
+        parameters['author'] = author
+        parameters['recipient'] = recipient
+        parameters['date'] = date
+        # we might have considered writing this
+        # socket.emit(recipient.nickname, json.dumps(parameters))
+        # however it won't work as-is because of the datetime filed which is not serializable
+        # it turns out flask knows how to serialize it, but for socketio we need to do it ourselves
+        # quick nd dirty way is this
+        # the message is sent only to the clients of the author and the recipient
+        # (and not to all the connected clients, which would then need to filter)
+        socketio.emit('new-message', json.dumps(parameters, default=str),
+                      to=[user_room(author_id), user_room(recipient_id)])
+        return parameters
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+
+
+# try it with
+"""
+http :5001/api/messages
+http :5001/api/messages limit==2
+http :5001/api/messages before==<the next_cursor from the previous answer>
+"""
+@app.route('/api/messages', methods=['GET'])
+def list_messages():
+    try:
+        before, after, limit = page_parameters()
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+    return get_messages(before, after, limit)
+
+
+# try it with
+"""
+http :5001/api/messages/with/1
+http :5001/api/messages/with/1 limit==2
+"""
+@app.route('/api/messages/with/<int:recipient_id>', methods=['GET'])
+def list_messages_to(recipient_id):
+    try:
+        before, after, limit = page_parameters()
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 422
+    return get_messages_with(recipient_id, before, after, limit)
+
+
+# the number of queries behind a conversation page must not depend on its length
+# this command makes sure of it, so that the N+1 problem cannot sneak back in:
+# it builds conversations of growing sizes - in a transaction that is rolled back
+# in the end, so the database is left untouched - and counts the queries of
+# list_messages_to(); it fails - with a non-zero exit code - if the count varies
+# each message comes from a different user: with the same 2 users all along,
+# the session would load each of them once, and hide the problem
+# (past 500 different users, selectinload needs one more query per batch of 500 ids;
+# that's fine, the count is still not one per message)
+# try it with
+"""
+flask check-queries
+flask check-queries --size 10 --size 200
+"""
+@app.cli.command('check-queries')
+@click.option('--size', type=int, multiple=True, default=[1, 10, 100, 500],
+              help='how many messages in the conversation - may be repeated')
+def check_queries(size):
+    # the statements sent to the database, whatever the code that sends them
+    queries = []
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+    counts = {}
+    with app.app_context():
+        bob = User(name="Bob", email="bob@check-queries", nickname="bob")
+        db.session.add(bob)
+        db.session.flush()
+        bob_id = bob.id
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+        try:
+            created = 0
+            for count in sorted(size):
+                for id in range(created, count):
+                    author = User(name=f"User {id}", email=f"user{id}@check-queries",
+                                  nickname=f"user{id}")
+                    db.session.add(Message(content=f"message number {id}", date=DateTime.now(),
+                                           author=author, recipient_id=bob_id))
+                db.session.flush()
+                created = count
+                # the first call warms up whatever may be cached along the way; and
+                # each call starts with an empty session, like a request would
+                for _ in range(2):
+                    db.session.expunge_all()
+                    queries.clear()
+                    with app.test_request_context():
+                        response = app.make_response(list_messages_to(bob_id))
+                if response.status_code != 200:
+                    raise click.ClickException(f"{count} messages: {response.get_json()}")
+                counts[count] = len(queries)
+                print(f"{count:>8,} messages: {counts[count]} queries")
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_query)
+            db.session.rollback()
+    if len(set(counts.values())) > 1:
+        raise click.ClickException("the number of queries depends on the number of messages")
+
+
+## Frontend
+# for clarity we define our routes in the /front namespace
+# however in practice /front/users would probably be just /users
+
+# the pages need the same data as the API exposes
+# by default they simply call the services above, within the same process
+# but in a more fragmented architecture, the API would be deployed as a separate
+# service; set CHAT_API_URL (e.g. to http://api.example.com) and the pages
+# will fetch their data over HTTP, like we did in the previous steps
+app.config['API_URL'] = os.environ.get('CHAT_API_URL')
+# in seconds - a page should rather fail than hang forever on a stuck API
+app.config['API_TIMEOUT'] = float(os.environ.get('CHAT_API_TIMEOUT', 5))
+# how many API calls can be in flight at the same time, for all pages together
+API_POOL_SIZE = 16
+
+# a requests.Session keeps its connections open (keep-alive) and reuses them,
+# instead of opening a new connection for each call
+api_session = requests.Session()
+api_session.mount('http://', HTTPAdapter(pool_maxsize=API_POOL_SIZE))
+api_session.mount('https://', HTTPAdapter(pool_maxsize=API_POOL_SIZE))
+# the threads that send the API calls on behalf of the pages
+api_executor = ThreadPoolExecutor(max_workers=API_POOL_SIZE)
+
+
+def call_api(path, service, *args):
+    """
+    returns what service(*args) returns - either by calling it directly,
+    or by requesting path on the remote API
+    """
+    api_url = app.config['API_URL']
+    if not api_url:
+        return service(*args)
+    req = api_session.get(api_url + path, timeout=app.config['API_TIMEOUT'])
+    if not (200 <= req.status_code < 300):
+        raise RuntimeError(f"could not request {path}: {req.status_code} {req.text}")
+    return req.json()
+
+
+def call_apis(*calls):
+    """
+    each call is a tuple (path, service, *args) as expected by call_api()
+    returns the list of their results, in the same order
+
+    over HTTP, the calls are sent all at once, so that we wait for the slowest one
+    instead of the sum of all of them
+    in-process, they are simply made one after the other, as the services
+    need the database session of the current request
+    """
+    if not app.config['API_URL']:
+        return [call_api(*call) for call in calls]
+    futures = [api_executor.submit(call_api, *call) for call in calls]
+    return [future.result() for future in futures]
+
+
+# try it by pointing your browser to
+"""
+http://localhost:5001/front/users
+"""
+@app.route('/front/users')
+def front_users():
+    try:
+        users = call_api('/api/users', get_users)
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 500
+    return render_template('users.html.j2', users=users, version=VERSION)
+
+
+# try it by pointing your browser to
+"""
+http://localhost:5001/front/messages/1
+"""
+@app.route('/front/messages/<int:recipient>')
+def front_messages(recipient):
+    try:
+        # the 3 calls do not depend on each other
+        user, page, users = call_apis(
+            (f'/api/users/{recipient}', get_user, recipient),
+            # this gives us the most recent page only; the older ones are fetched
+            # by the JS code, if and when the user asks for them
+            (f'/api/messages/with/{recipient}', get_messages_with, recipient),
+            ('/api/users', get_users),
+        )
+    except Exception as exc:
+        return dict(error=f"{type(exc)}: {exc}"), 500
+    return render_template(
+        'messages.html.j2',
+        user=user, messages=page['messages'], next_cursor=page['next_cursor'],
+        users=users,
+    )
+
+## SocketIO
+
+def user_room(user_id):
+    return f"user-{user_id}"
+
+
+# each client tells us, when it connects, which user it is acting for
+# so we can put it in the room of that user
+# NOTE: there is no authentication in this app, so we have to trust the client on that
+@socketio.on('connect')
+def connect(auth):
+    user_id = (auth or {}).get('user_id')
+    if user_id is None:
+        # refuse the connection
+        return False
+    join_room(user_room(user_id))
+
+
+#
+# cannot be triggered through http
+# there is a socket-io CLI client that can be installed with
+# npm i -g socket.io-cli
+# in our case, the first test will be from the messages HTML page
+#
+@socketio.on('connect-ack')
+def connect_ack(message):
+    print(f'received ACK message: {message} of type {type(message)}')
+
+# what one message costs to deliver as the number of connected clients grows,
+# with the rooms, and with the broadcast that create_message did before
+# the clients are Flask-SocketIO test clients: the server handles them like real ones,
+# except that what it sends them lands in a list in memory rather than on a socket
+# each client acts for its own user, and the messages go from user 1 to user 2
+# try it with
+"""
+flask bench-fanout
+flask bench-fanout --clients 100 --clients 10000 --messages 20
+"""
+@app.cli.command('bench-fanout')
+@click.option('--clients', type=int, multiple=True, default=[100, 1000, 10_000],
+              help='how many connected clients - may be repeated')
+@click.option('--messages', default=100, help='how many messages for each measure')
+def bench_fanout(clients, messages):
+    payload = json.dumps(dict(content="hello", author_id=1, recipient_id=2,
+                              date=DateTime.now()), default=str)
+    emits = {
+        'rooms': lambda: socketio.emit('new-message', payload,
+                                       to=[user_room(1), user_room(2)]),
+        'broadcast': lambda: socketio.emit('user2', payload),
+    }
+    for count in clients:
+        connected = [socketio.test_client(app, auth=dict(user_id=id + 1))
+                     for id in range(count)]
+        for name, emit in emits.items():
+            start = time.perf_counter()
+            for _ in range(messages):
+                emit()
+            elapsed = (time.perf_counter() - start) / messages
+            received = sum(len(client.get_received()) for client in connected)
+            print(f"{count:>8,} clients - {name:>9}: {elapsed * 1e6:>10,.1f} µs per message, "
+                  f"{received / messages:>8,.0f} clients reached")
+        for client in connected:
+            client.disconnect()
+
+
+## idle connections
+# to see what a connection costs the server, we need a lot of them; the python-socketio
+# client would need a thread per connection on our side too, so we speak the protocol
+# by hand, with asyncio: the websocket handshake, the SocketIO connect packet, and
+# from then on we only answer the pings
+
+def write_frame(writer, text):
+    # a client must mask its frames - with any key it likes; ours are all short
+    payload = text.encode()
+    mask = os.urandom(4)
+    writer.write(bytes([0x81, 0x80 | len(payload)]) + mask
+                 + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)))
+
+
+async def read_frame(reader):
+    # the server does not mask its frames
+    header = await reader.readexactly(2)
+    length = header[1] & 0x7f
+    if length == 126:
+        length = int.from_bytes(await reader.readexactly(2), 'big')
+    elif length == 127:
+        length = int.from_bytes(await reader.readexactly(8), 'big')
+    return (await reader.readexactly(length)).decode()
+
+
+async def open_socket(port, user_id):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write(f"GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\n"
+                 f"Host: 127.0.0.1:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                 f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode())
+    headers = await reader.readuntil(b"\r\n\r\n")
+    if not headers.startswith(b"HTTP/1.1 101"):
+        raise ConnectionError(f"no websocket: {headers.splitlines()[0].decode()}")
+    # the Engine.IO open packet, then we connect like script.js does
+    await read_frame(reader)
+    write_frame(writer, '40' + json.dumps(dict(user_id=user_id)))
+    answer = await read_frame(reader)
+    if not answer.startswith('40'):
+        raise ConnectionError(f"connection refused: {answer[:40]!r}")
+    return reader, writer
+
+
+async def keep_alive(reader, writer):
+    # the server pings every 25 seconds, and drops the clients that don't answer
+    try:
+        while True:
+            if await read_frame(reader) == '2':
+                write_frame(writer, '3')
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+
+
+def resident_memory(pid):
+    # in kB; this is Linux only
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+async def open_first_socket(port, user_id):
+    # the server takes a moment to start listening
+    for _ in range(100):
+        try:
+            return await open_socket(port, user_id)
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"the server on port {port} did not start")
+
+
+async def measure_connections(pid, port, counts):
+    sockets = [await open_first_socket(port, 1)]
+    tasks = [asyncio.create_task(keep_alive(*sockets[0]))]
+    # the first connection loads whatever code is loaded lazily, so it is not counted
+    await asyncio.sleep(1)
+    before = resident_memory(pid)
+    results = []
+    try:
+        for count in counts:
+            while len(sockets) - 1 < count:
+                # not all at once, the listen queue of the server is not that long
+                batch = min(100, count - len(sockets) + 1)
+                opened = await asyncio.gather(*(open_socket(port, id % 100 + 1)
+                                                for id in range(len(sockets), len(sockets) + batch)))
+                tasks += [asyncio.create_task(keep_alive(*socket)) for socket in opened]
+                sockets += opened
+            await asyncio.sleep(1)
+            results.append((count, resident_memory(pid) - before))
+    except (OSError, asyncio.IncompleteReadError) as exc:
+        # the server has had enough - which is also a result
+        results.append((len(sockets) - 1, exc))
+    for _, writer in sockets:
+        writer.close()
+    for task in tasks:
+        task.cancel()
+    return results
+
+
+# the memory of the server for idle connections, in each async mode
+# the command starts the server - python app.py - in a subprocess, for each mode in turn,
+# then opens the connections and reads the resident memory of the server process
+# mind the limit on open files, e.g. ulimit -n 20000 for 10,000 connections
+# try it with
+"""
+flask bench-connections
+flask bench-connections --mode eventlet --count 1000 --count 10000
+"""
+@app.cli.command('bench-connections')
+@click.option('--mode', 'modes', multiple=True, default=['threading', 'eventlet', 'gevent'],
+              help='the async modes to measure - may be repeated')
+@click.option('--count', type=int, multiple=True, default=[1000, 5000],
+              help='how many idle connections - may be repeated')
+@click.option('--port', default=5099, help='where to run the server')
+def bench_connections(modes, count, port):
+    for mode in modes:
+        if mode != 'threading' and importlib.util.find_spec(mode) is None:
+            print(f"{mode:>10}: pip install {mode} first")
+            continue
+        # without FLASK_RUN_FROM_CLI, that the flask command sets, and that would
+        # turn the server's socketio.run() into a no-op
+        env = {name: value for name, value in os.environ.items() if name != 'FLASK_RUN_FROM_CLI'}
+        server = subprocess.Popen(
+            [sys.executable, __file__, '--port', str(port)],
+            env=dict(env, CHAT_ASYNC_MODE=mode),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            results = asyncio.run(measure_connections(server.pid, port, sorted(count)))
+        finally:
+            server.terminate()
+            server.wait()
+        for connections, memory in results:
+            if isinstance(memory, Exception):
+                print(f"{mode:>10}: failed after {connections:,} connections: {memory}")
+                continue
+            print(f"{mode:>10}: {connections:>7,} connections: {memory / 1024:>8,.1f} MB, "
+                  f"{memory / connections:>6,.1f} kB per connection")
+
+
+## several workers
+# a check that the message queue does its job, and how many messages go through it
+
+async def count_events(reader, writer, event, received):
+    # like keep_alive, but we also note when each event comes in
+    prefix = f'42["{event}"'
+    try:
+        while True:
+            frame = await read_frame(reader)
+            if frame == '2':
+                write_frame(writer, '3')
+            elif frame.startswith(prefix):
+                received.append(time.perf_counter())
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+
+
+async def relay_messages(ports, users, count):
+    """
+    posts count messages to the first worker, with a client of the recipient
+    connected to each worker; returns when each message was posted, and when
+    each event came in, for each worker
+    """
+    sockets = [await open_first_socket(port, users[1]) for port in ports]
+    received = [[] for _ in ports]
+    tasks = [asyncio.create_task(count_events(*socket, 'new-message', times))
+             for socket, times in zip(sockets, received)]
+    posted = []
+    def post_all():
+        with requests.Session() as session:
+            for id in range(count):
+                posted.append(time.perf_counter())
+                response = session.post(f"http://127.0.0.1:{ports[0]}/api/messages", json=dict(
+                    author_id=users[0], recipient_id=users[1], content=f"relayed message {id}"))
+                response.raise_for_status()
+    await asyncio.to_thread(post_all)
+    # the last ones may still be on their way, through the queue
+    deadline = time.perf_counter() + 10
+    while any(len(times) < count for times in received) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    for _, writer in sockets:
+        writer.close()
+    for task in tasks:
+        task.cancel()
+    return posted, received
+
+
+# starts several workers - python app.py - sharing one message queue, connects a client
+# to each of them, and posts messages to the first one: each client must get them all
+# the command fails - with a non-zero exit code - if some messages did not make it
+# the messages are actually created, between the first 2 users - so better use a scratch database
+# try it with
+"""
+flask bench-queue
+flask bench-queue --workers 4 --messages 2000
+flask bench-queue --queue redis://localhost:6379/0
+flask bench-queue --workers 1 --queue ''
+"""
+@app.cli.command('bench-queue')
+@click.option('--workers', default=2, help='how many worker processes')
+@click.option('--messages', default=500, help='how many messages to post')
+@click.option('--queue', default=None,
+              help='the URL of the message queue - a scratch SQLite file by default')
+@click.option('--port', default=5090, help='where to run the first worker, the others go above')
+def bench_queue(workers, messages, queue, port):
+    with app.app_context():
+        users = [user.id for user in User.query.limit(2)]
+    if len(users) < 2:
+        print("create at least 2 users first")
+        return
+    if queue is None:
+        queue = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'queue.db')
+    # see bench-connections about FLASK_RUN_FROM_CLI
+    env = {name: value for name, value in os.environ.items() if name != 'FLASK_RUN_FROM_CLI'}
+    ports = [port + worker for worker in range(workers)]
+    servers = [subprocess.Popen(
+                   [sys.executable, __file__, '--port', str(worker_port)],
+                   env=dict(env, CHAT_MESSAGE_QUEUE=queue),
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+               for worker_port in ports]
+    try:
+        posted, received = asyncio.run(relay_messages(ports, users, messages))
+    finally:
+        for server in servers:
+            server.terminate()
+        for server in servers:
+            server.wait()
+    for worker, times in enumerate(received):
+        if not times:
+            print(f"worker {worker}: received no message")
+            continue
+        # the events come in the order of the posts
+        latencies = sorted(got - sent for sent, got in zip(posted, times))
+        print(f"worker {worker}: received {len(times):>7,} of {messages:,} messages - "
+              f"{len(times) / (times[-1] - posted[0]):>6,.0f} messages/s, latency "
+              f"{latencies[len(latencies) // 2] * 1000:>6.1f} ms median, "
+              f"{latencies[-1] * 1000:>6.1f} ms max")
+    if any(len(times) < messages for times in received):
+        raise click.ClickException("some messages did not reach all the workers")
+
+
+# flask run only knows about the threading mode
+# so to use eventlet or gevent, run this file instead, e.g.
+"""
+CHAT_ASYNC_MODE=eventlet python app.py --port 5001
+"""
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--max-connections', type=int, default=100_000,
+                        help='eventlet only; it serves at most 1024 connections by default')
+    args = parser.parse_args()
+    print(f"starting in {socketio.async_mode} mode")
+    options = {}
+    if socketio.async_mode == 'eventlet':
+        # each open connection holds one green thread of the server's pool
+        options['max_size'] = args.max_connections
+    # in threading mode, the server is the one from werkzeug, that is not meant
+    # for production; we're fine with that
+    socketio.run(app, host=args.host, port=args.port, debug=args.debug,
+                 allow_unsafe_werkzeug=True, **options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+// surprisingly there is no way to tell a <form> that it should submit as JSON
+
+const formToJSON = form => Object.fromEntries(new FormData(form))
+
+document.addEventListener('DOMContentLoaded', async (event) => {
+    console.log("connecting to the SocketIO backend")
+    // we are storing the nickname and the user id in the body element
+    const nickname = document.body.dataset.nickname
+    const user_id = document.body.dataset.userId
+    // the backend uses user_id to put us in the room of that user
+    const socket = io({auth: {user_id}})
+    const message_row = (data) => {
+        // an object, as SocketIO decodes the JSON for us
+        const {author, recipient, content, date} = data
+        const newRow = document.createElement('tr')
+        newRow.innerHTML = `<td>${date}</td><td>${author.nickname}</td><td>${recipient.nickname}</td><td>${content}</td>`
+        return newRow
+    }
+    const tbody = document.querySelector('#messages tbody')
+    const display_new_message = (data) => tbody.appendChild(message_row(data))
+    socket.on('connect', () => {
+        console.log('Connected!')
+        socket.emit('connect-ack', {messages: `${nickname} has connected!`})
+    })
+    // we receive only the messages that we send or receive
+    socket.on('new-message', (message) => display_new_message(message))
+    // messages created in bulk come in batches
+    socket.on('new-messages', (messages) => messages.forEach(display_new_message))
+    // the page comes with the most recent messages only
+    // older ones are fetched one page at a time, when the user asks for them
+    const older = document.getElementById('older-messages')
+    older?.addEventListener('click', async () => {
+        const cursor = encodeURIComponent(older.dataset.cursor)
+        const response = await fetch(`/api/messages/with/${user_id}?before=${cursor}`)
+        const {messages, next_cursor} = await response.json()
+        // the page is in chronological order, so we insert from the end
+        for (const message of messages.reverse())
+            tbody.prepend(message_row(message))
+        if (next_cursor)
+            older.dataset.cursor = next_cursor
+        else
+            older.remove()
+    })
+    document.getElementById('send-form').addEventListener('submit',
+        async (event) => {
+            // turn off default form behaviour
+            event.preventDefault()
+            const json = formToJSON(event.target)
+            const action = event.target.action
+            await fetch(action, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(json)
+            })
+            // no need to display the message here, it will come back
+            // through the socket, like the ones we receive
+            .catch((error) => {
+                console.error('Error:', error)
+            })
+        })
+    })
\ No newline at end of file
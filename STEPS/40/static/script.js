@@ -0,0 +1,173 @@
+// surprisingly there is no way to tell a <form> that it should submit as JSON
+
+const formToJSON = form => Object.fromEntries(new FormData(form))
+
+// a minimal MessagePack decoder, for what our server sends - see pack() in app.py:
+// nil, booleans, integers, floats, strings, binary, arrays and maps
+// it fits in a few lines, and saves us from loading a library from a third-party CDN
+const MessagePack = {
+    decode: (buffer) => {
+        const bytes = (buffer instanceof Uint8Array) ? buffer : new Uint8Array(buffer)
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength)
+        const utf8 = new TextDecoder()
+        let offset = 0
+        // reads a number of the given type, e.g. getUint16, and moves past it
+        const read = (method, size) => {
+            const result = view[method](offset)
+            offset += size
+            return result
+        }
+        const slice = (length) => bytes.subarray(offset, offset += length)
+        const string = (length) => utf8.decode(slice(length))
+        const array = (length) => {
+            const result = []
+            for (let i = 0; i < length; i++)
+                result.push(value())
+            return result
+        }
+        const map = (length) => {
+            const result = {}
+            for (let i = 0; i < length; i++) {
+                const key = value()
+                result[key] = value()
+            }
+            return result
+        }
+        const value = () => {
+            const type = bytes[offset++]
+            // the types that hold a small value - or length - in the type byte itself
+            if (type <= 0x7f) return type
+            if (type <= 0x8f) return map(type & 0x0f)
+            if (type <= 0x9f) return array(type & 0x0f)
+            if (type <= 0xbf) return string(type & 0x1f)
+            if (type >= 0xe0) return type - 0x100
+            switch (type) {
+                case 0xc0: return null
+                case 0xc2: return false
+                case 0xc3: return true
+                case 0xc4: return slice(read('getUint8', 1)).slice()
+                case 0xc5: return slice(read('getUint16', 2)).slice()
+                case 0xc6: return slice(read('getUint32', 4)).slice()
+                case 0xca: return read('getFloat32', 4)
+                case 0xcb: return read('getFloat64', 8)
+                case 0xcc: return read('getUint8', 1)
+                case 0xcd: return read('getUint16', 2)
+                case 0xce: return read('getUint32', 4)
+                case 0xcf: return Number(read('getBigUint64', 8))
+                case 0xd0: return read('getInt8', 1)
+                case 0xd1: return read('getInt16', 2)
+                case 0xd2: return read('getInt32', 4)
+                case 0xd3: return Number(read('getBigInt64', 8))
+                case 0xd9: return string(read('getUint8', 1))
+                case 0xda: return string(read('getUint16', 2))
+                case 0xdb: return string(read('getUint32', 4))
+                case 0xdc: return array(read('getUint16', 2))
+                case 0xdd: return array(read('getUint32', 4))
+                case 0xde: return map(read('getUint16', 2))
+                case 0xdf: return map(read('getUint32', 4))
+            }
+            throw new Error(`unsupported MessagePack type 0x${type.toString(16)}`)
+        }
+        return value()
+    },
+}
+
+// in MessagePack mode, the messages come in columnar form, with the users on the side
+// (see compact_messages() in app.py); this turns them back into a list of objects
+const expand_messages = ({users, messages}) => {
+    const users_by_id = Object.fromEntries(users.map(user => [user.id, user]))
+    const {author_id, recipient_id, ...columns} = messages
+    return author_id.map((_, i) => ({
+        ...Object.fromEntries(Object.entries(columns).map(([key, values]) => [key, values[i]])),
+        author: users_by_id[author_id[i]],
+        recipient: users_by_id[recipient_id[i]],
+    }))
+}
+
+// decodes a response or an event payload, and tells how big and how long it was
+// so that both formats can be compared in the browser console
+// either way, we end up with the messages as a list of objects
+const decode = (body, wire) => {
+    const start = performance.now()
+    let result
+    if (wire === 'msgpack') {
+        result = MessagePack.decode(body)
+        result.messages = expand_messages(result)
+    } else {
+        result = JSON.parse(body)
+    }
+    const size = (wire === 'msgpack') ? body.byteLength : body.length
+    console.log(`${wire}: ${size} bytes decoded in ${(performance.now() - start).toFixed(3)} ms`)
+    return result
+}
+
+document.addEventListener('DOMContentLoaded', async (event) => {
+    console.log("connecting to the SocketIO backend")
+    // we are storing the nickname and the user id in the body element
+    const nickname = document.body.dataset.nickname
+    const user_id = document.body.dataset.userId
+    // either json or msgpack
+    const wire = document.body.dataset.wire
+    // the backend uses user_id to put us in the room of that user
+    // and wire to know in which format we want the events
+    const socket = io({auth: {user_id, wire}})
+    const message_row = (data) => {
+        // an object, as SocketIO decodes the JSON for us - or expand_messages() did
+        const {author, recipient, content, date} = data
+        const newRow = document.createElement('tr')
+        newRow.innerHTML = `<td>${date}</td><td>${author.nickname}</td><td>${recipient.nickname}</td><td>${content}</td>`
+        return newRow
+    }
+    const tbody = document.querySelector('#messages tbody')
+    const display_new_message = (data) => tbody.appendChild(message_row(data))
+    socket.on('connect', () => {
+        console.log('Connected!')
+        socket.emit('connect-ack', {messages: `${nickname} has connected!`})
+    })
+    // we receive only the messages that we send or receive
+    // in MessagePack mode, both events hold a list of messages, as bytes
+    if (wire === 'msgpack') {
+        const display_packed = (bytes) => decode(bytes, wire).messages.forEach(display_new_message)
+        socket.on('new-message', display_packed)
+        socket.on('new-messages', display_packed)
+    } else {
+        socket.on('new-message', (message) => display_new_message(message))
+        // messages created in bulk come in batches
+        socket.on('new-messages', (messages) => messages.forEach(display_new_message))
+    }
+    // the page comes with the most recent messages only
+    // older ones are fetched one page at a time, when the user asks for them
+    const older = document.getElementById('older-messages')
+    older?.addEventListener('click', async () => {
+        const cursor = encodeURIComponent(older.dataset.cursor)
+        const response = await fetch(`/api/messages/with/${user_id}?before=${cursor}`, {
+            headers: {'Accept': (wire === 'msgpack') ? 'application/msgpack' : 'application/json'}
+        })
+        const body = (wire === 'msgpack') ? await response.arrayBuffer() : await response.text()
+        const {messages, next_cursor} = decode(body, wire)
+        // the page is in chronological order, so we insert from the end
+        for (const message of messages.reverse())
+            tbody.prepend(message_row(message))
+        if (next_cursor)
+            older.dataset.cursor = next_cursor
+        else
+            older.remove()
+    })
+    document.getElementById('send-form').addEventListener('submit',
+        async (event) => {
+            // turn off default form behaviour
+            event.preventDefault()
+            const json = formToJSON(event.target)
+            const action = event.target.action
+            await fetch(action, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(json)
+            })
+            // no need to display the message here, it will come back
+            // through the socket, like the ones we receive
+            .catch((error) => {
+                console.error('Error:', error)
+            })
+        })
+    })
\ No newline at end of file